@@ -1,13 +1,138 @@
 
 from PyQt5.QtWidgets import (
     QMainWindow, QWidget, QLabel, QPushButton, QVBoxLayout,
-    QHBoxLayout, QFileDialog, QMessageBox, QApplication, QLineEdit
+    QHBoxLayout, QFileDialog, QMessageBox, QLineEdit
+)
+from PyQt5.QtGui import QPixmap, QImage, QImageReader, QImageIOHandler, QPainter
+from PyQt5.QtCore import (
+    Qt, QSize, QRect, QObject, QRunnable, QThreadPool, pyqtSignal
 )
-from PyQt5.QtGui import QPixmap
-from PyQt5.QtCore import Qt
 import os
+import re
+import stat
+from collections import OrderedDict
+from contextlib import contextmanager
 from worker import ProcessingThread
 
+# Positive decimal (optional leading "+" and exponent) typed into the pixel size box
+_PX_RE = re.compile(r'^\s*\+?((?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)\s*$')
+
+_RESULT_PLACEHOLDER = "Segmentation Result will appear here"
+_EMPTY_RESULT_TEXT = "Cells: —    Mean area: —"
+
+# Recurring result_label stylesheets
+_PLACEHOLDER_STYLE = "border: 2px dashed gray; color: gray; font-style: italic;"
+_ERROR_STYLE = "color: red;"
+
+_QT_MAX_SIZE = 16777215   # QWIDGETSIZE_MAX: "unbounded" for a QSize dimension
+
+# Decoded previews kept for re-selected images (~0.5 MB each at label height)
+_PREVIEW_CACHE_SIZE = 8
+
+
+def _fit_size(size, target):
+    """Size of `size` shrunk to fit `target` with its aspect ratio; never enlarged."""
+    if size.width() <= target.width() and size.height() <= target.height():
+        return QSize(size)
+    return size.scaled(target, Qt.KeepAspectRatio)
+
+
+def _scaled_two_step(image, target):
+    """
+    Fit `image` into `target` (keeping aspect ratio) cheaply: a nearest-neighbour
+    pass down to ~2x the target, then a smooth pass only on that small image.
+    """
+    final = _fit_size(image.size(), target)
+    if final == image.size():
+        return image
+    if image.width() > 2 * final.width() and image.height() > 2 * final.height():
+        image = image.scaled(final * 2, Qt.KeepAspectRatio, Qt.FastTransformation)
+    return image.scaled(final, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+
+def _array_to_qimage(rgb, target):
+    """Fit an HxWx3 uint8 RGB array into `target` as a QImage that owns its pixels."""
+    h, w = rgb.shape[:2]
+    image = QImage(rgb.data, w, h, 3 * w, QImage.Format_RGB888)
+    scaled = _scaled_two_step(image, target)
+    # `image` only wraps the array's buffer; copy it if no scaling made a new one
+    return scaled.copy() if scaled is image else scaled
+
+
+class _PreviewLabel(QLabel):
+    """
+    QLabel that paints its pixmap fitted to the current widget size
+    (keeping aspect ratio), so previews follow window resizes without
+    re-scaling the pixmap on the CPU for every display.
+    """
+    def __init__(self, text=""):
+        super().__init__(text)
+        self._pix = None
+
+    def setPixmap(self, pixmap):
+        self._pix = None if pixmap is None or pixmap.isNull() else pixmap
+        self.update()
+
+    def pixmap(self):
+        return self._pix
+
+    def setText(self, text):
+        # Mirror QLabel: showing a message replaces the picture
+        if text:
+            self._pix = None
+        super().setText(text)
+
+    def clear(self):
+        self._pix = None
+        super().clear()
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self._pix is None:
+            return
+        area = self.contentsRect()
+        size = self._pix.size().scaled(area.size(), Qt.KeepAspectRatio)
+        target = QRect(0, 0, size.width(), size.height())
+        target.moveCenter(area.center())
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.drawPixmap(target, self._pix)
+        painter.end()
+
+
+class _DecodeSignals(QObject):
+    """Signal holder for _DecodeTask (QRunnable is not a QObject)."""
+    done = pyqtSignal(object, QImage)
+
+
+class _DecodeTask(QRunnable):
+    """
+    Decode an image file at preview resolution on a QThreadPool thread.
+
+    Emits signals.done(key, QImage); the QImage is null if decoding failed.
+    """
+    def __init__(self, key, path, target, signals):
+        super().__init__()
+        self.key = key
+        self.path = path
+        self.target = target
+        self.signals = signals
+
+    def run(self):
+        # Ask the image plugin to decode straight at preview resolution
+        # (JPEG/TIFF can downscale while decoding) instead of full size.
+        # Plugins without that option (e.g. PNG) would fall back to a smooth
+        # resample of the full image, so scale those ourselves in two steps.
+        reader = QImageReader(self.path)
+        size = reader.size()
+        in_decoder = size.isValid() and reader.supportsOption(QImageIOHandler.ScaledSize)
+        if in_decoder:
+            reader.setScaledSize(_fit_size(size, self.target))
+        image = reader.read()
+        if not image.isNull() and not in_decoder:
+            image = _scaled_two_step(image, self.target)
+        self.signals.done.emit(self.key, image)
+
 
 class CellposeApp(QMainWindow):
     """
@@ -32,6 +157,14 @@ class CellposeApp(QMainWindow):
         self.current_image = None
         self.output_folder = None
         self.is_processing = False
+        self._cancelling = False
+        self._current_qimage = None   # decoded preview of current_image
+        self._preview_cache = OrderedDict()   # (path, height) -> preview QImage, LRU order
+        self._pending_previews = {}   # preview QLabel -> key being decoded for it
+
+        # Previews are decoded off the GUI thread; results come back queued
+        self._decode_signals = _DecodeSignals(self)
+        self._decode_signals.done.connect(self._on_preview_decoded)
 
         # Root widget and main layout
         self.central_widget = QWidget()
@@ -42,17 +175,15 @@ class CellposeApp(QMainWindow):
         self.preview_row = QHBoxLayout()
 
         # Input image area
-        self.image_label = QLabel("Drag & Drop or Click to Upload Image")
+        self.image_label = _PreviewLabel("Drag & Drop or Click to Upload Image")
         self.image_label.setAlignment(Qt.AlignCenter)
         self.image_label.setStyleSheet("border: 2px dashed gray;")
         self.image_label.setFixedHeight(320)
 
         # Result image area
-        self.result_label = QLabel("Segmentation Result will appear here")
+        self.result_label = _PreviewLabel(_RESULT_PLACEHOLDER)
         self.result_label.setAlignment(Qt.AlignCenter)
-        self.result_label.setStyleSheet(
-            "border: 2px dashed gray; color: gray; font-style: italic;"
-        )
+        self.result_label.setStyleSheet(_PLACEHOLDER_STYLE)
         self.result_label.setFixedHeight(320)
 
         self.preview_row.addWidget(self.image_label, 1)
@@ -60,7 +191,7 @@ class CellposeApp(QMainWindow):
         self.layout.addLayout(self.preview_row)
 
         # Inline result info (cell count + areas) with larger font
-        self.result_info = QLabel("Cells: —    Mean area: —")
+        self.result_info = QLabel(_EMPTY_RESULT_TEXT)
         self.result_info.setAlignment(Qt.AlignCenter)
         self.result_info.setStyleSheet("""
             QLabel {
@@ -78,6 +209,15 @@ class CellposeApp(QMainWindow):
         # Accept drag & drop on the window
         self.setAcceptDrops(True)
 
+        # File dialogs are built once and reused, not recreated on every click
+        self._open_dlg = QFileDialog(self, "Select Image")
+        self._open_dlg.setNameFilter("Images (*.png *.jpg *.tif *.tiff)")
+        self._open_dlg.setFileMode(QFileDialog.ExistingFile)
+
+        self._folder_dlg = QFileDialog(self, "Select Output Folder")
+        self._folder_dlg.setFileMode(QFileDialog.Directory)
+        self._folder_dlg.setOption(QFileDialog.ShowDirsOnly, True)
+
         # Pixel size input (optional)
         pixel_layout = QHBoxLayout()
         pixel_layout.addWidget(QLabel("Pixel size (µm/pixel, optional):"))
@@ -133,44 +273,91 @@ class CellposeApp(QMainWindow):
 
     # ---------- UI ----------
     def upload_image(self):
-        fname, _ = QFileDialog.getOpenFileName(
-            self, "Select Image", "", "Images (*.png *.jpg *.tif *.tiff)"
-        )
-        if fname:
-            self.load_image(fname)
+        if self._open_dlg.exec_():
+            self.load_image(self._open_dlg.selectedFiles()[0])
 
     def load_image(self, fname):
         """Set current image and update the preview"""
         self.current_image = fname
-        pixmap = QPixmap(fname)
-        scaled = pixmap.scaled(
-            self.image_label.width(),
-            self.image_label.height(),
-            Qt.KeepAspectRatio,
-            Qt.SmoothTransformation
+        with self._batched_updates():
+            self._show_preview(fname, self.image_label)
+            self.image_label.setStyleSheet("")
+            self.image_label.setText("")
+            self.result_info.setText(_EMPTY_RESULT_TEXT)
+
+    @contextmanager
+    def _batched_updates(self):
+        """Suspend repaints of the central widget while several children change"""
+        self.central_widget.setUpdatesEnabled(False)
+        try:
+            yield
+        finally:
+            self.central_widget.setUpdatesEnabled(True)
+
+    def _preview_key(self, path, label):
+        # Preview labels have a fixed height and stretch horizontally; decode
+        # to that height and let _PreviewLabel fit the width when painting.
+        return (path, label.height())
+
+    def _show_preview(self, path, label):
+        """Show a preview of `path` in `label`, decoding in the thread pool on a cache miss"""
+        key = self._preview_key(path, label)
+        image = self._preview_cache.get(key)
+        if image is not None:
+            self._preview_cache.move_to_end(key)
+            self._pending_previews.pop(label, None)
+            self._set_preview(label, image)
+            return
+
+        self._pending_previews[label] = key
+        QThreadPool.globalInstance().start(
+            _DecodeTask(key, path, QSize(_QT_MAX_SIZE, label.height()), self._decode_signals)
         )
-        self.image_label.setPixmap(scaled)
-        self.image_label.setStyleSheet("")
-        self.image_label.setText("")
-        self.result_info.setText("Cells: —    Mean area: —")
+
+    def _set_preview(self, label, image):
+        # QImage stays the stored form; the QPixmap (a GUI-thread, possibly
+        # GPU-backed resource) is only created at the moment it is shown.
+        if label is self.image_label:
+            self._current_qimage = image
+        label.setPixmap(QPixmap.fromImage(image))
+
+    def _on_preview_decoded(self, key, image):
+        if not image.isNull():
+            self._preview_cache[key] = image
+            self._preview_cache.move_to_end(key)
+            while len(self._preview_cache) > _PREVIEW_CACHE_SIZE:
+                self._preview_cache.popitem(last=False)
+
+        # Only apply to labels still waiting for this image (a newer
+        # load may have replaced the request while it was decoding).
+        for label, pending in list(self._pending_previews.items()):
+            if pending != key:
+                continue
+            del self._pending_previews[label]
+            if not image.isNull():
+                self._set_preview(label, image)
+            elif label is self.result_label:
+                self.result_label.setText("No result image found.")
+                self.result_label.setStyleSheet(_ERROR_STYLE)
+            else:
+                self._current_qimage = None
+                label.setPixmap(QPixmap())
 
     def reset_result_preview(self):
         self.result_label.clear()                 
         self.result_label.setPixmap(QPixmap())    
-        self.result_label.setText("Segmentation Result will appear here")
+        self.result_label.setText(_RESULT_PLACEHOLDER)
         self.result_label.setAlignment(Qt.AlignCenter)
-        self.result_label.setStyleSheet("border: 2px dashed gray; color: gray; font-style: italic;")
+        self.result_label.setStyleSheet(_PLACEHOLDER_STYLE)
 
 
     def select_output_folder(self):
-        folder = QFileDialog.getExistingDirectory(self, "Select Output Folder")
+        folder = self._folder_dlg.selectedFiles()[0] if self._folder_dlg.exec_() else ""
         if folder:
             self.output_folder = folder
             self.output_path_label.setText(folder)
             self.output_path_label.setStyleSheet("color: green; font-weight: bold;")
-            self.output_path_label.adjustSize()
-            self.output_path_label.repaint()
-            QApplication.processEvents()
+            self.output_path_label.update()
 
     def start_analysis(self):
         if self.is_processing:
@@ -180,11 +367,17 @@ class CellposeApp(QMainWindow):
         if not self.current_image:
             QMessageBox.warning(self, "Warning", "Please upload an image first!")
             return
-        if not os.path.exists(self.current_image):
+        try:
+            os.stat(self.current_image)
+        except OSError:
             QMessageBox.critical(self, "Error", f"File not found: {self.current_image}")
             return
 
-        if not self.output_folder or not os.path.isdir(self.output_folder):
+        try:
+            folder_ok = bool(self.output_folder) and stat.S_ISDIR(os.stat(self.output_folder).st_mode)
+        except OSError:
+            folder_ok = False
+        if not folder_ok:
             QMessageBox.warning(self, "Warning", "Please choose an output folder first!")
             return
 
@@ -193,57 +386,44 @@ class CellposeApp(QMainWindow):
         # Fixed model
         model = "cyto"
 
-        self.is_processing = True
-        self.start_button.setEnabled(False)
-        self.cancel_button.setEnabled(True)
+        self._set_processing(True)
 
+        self._pending_previews.pop(self.result_label, None)
         self.result_label.setStyleSheet("color: gray;")
         self.result_label.setText("Processing...")
 
         self.processing_thread = ProcessingThread(
             self.current_image, diameter, model, self.output_folder
         )
-        self.processing_thread.finished.connect(self.on_processing_finished)
-        self.processing_thread.error.connect(self.on_processing_error)
+        # Queued explicitly: slots must run on the GUI thread, never in the worker
+        self.processing_thread.finished.connect(self.on_processing_finished, Qt.QueuedConnection)
+        self.processing_thread.error.connect(self.on_processing_error, Qt.QueuedConnection)
+        self.processing_thread.cancelled.connect(self._on_cancelled, Qt.QueuedConnection)
         self.processing_thread.start()
 
-    def on_processing_finished(self, results):
-        self.is_processing = False
-        self.start_button.setEnabled(True)
-        self.cancel_button.setEnabled(False)
-
-        # Show result image
-        show_path = results.get("overlay_path") or results.get("mask_path")
-        if show_path and os.path.exists(show_path):
-            pix = QPixmap(show_path)
-            self.result_label.setPixmap(
-                pix.scaled(
-                    self.result_label.width(),
-                    self.result_label.height(),
-                    Qt.KeepAspectRatio,
-                    Qt.SmoothTransformation
-                )
-            )
-            self.result_label.setStyleSheet("")
-            self.result_label.setText("")
-        else:
-            self.result_label.setText("No result image found.")
-            self.result_label.setStyleSheet("color: red;")
+    def _set_processing(self, running):
+        self.is_processing = running
+        self.start_button.setEnabled(not running)
+        self.cancel_button.setEnabled(running)
 
+    def on_processing_finished(self, results):
+        if self._cancelling:
+            # Finished just before it saw the cancel request; drop the result
+            # (but still clean up its mask file, as a normal finish would)
+            self._remove_mask_file(results.get("mask_path"))
+            self._on_cancelled()
+            return
         # Extract metrics
         cell_count = results.get("cell_count", 0)
         mean_area_px = results.get("mean_area_px", 0.0)
 
         # Try to compute mean area in µm^2 if pixel size is provided
-        pixel_size_text = self.pixel_size_input.text().strip()
+        # (empty or invalid values are ignored, just show px^2)
+        m = _PX_RE.match(self.pixel_size_input.text())
+        px_size = float(m.group(1)) if m else 0.0
         mean_area_um2 = None
-        if pixel_size_text:
-            try:
-                px_size = float(pixel_size_text)
-                if px_size > 0:
-                    mean_area_um2 = mean_area_px * (px_size ** 2)
-            except ValueError:
-                mean_area_um2 = None  # ignore invalid value, just show px^2
+        if px_size > 0:
+            mean_area_um2 = mean_area_px * px_size * px_size
 
         # Build result info text
         if mean_area_um2 is not None:
@@ -255,28 +435,73 @@ class CellposeApp(QMainWindow):
         else:
             text = f"Cells: {cell_count}    Mean area: {mean_area_px:.1f} px^2"
 
-        self.result_info.setText(text)
-
-        # Auto-delete mask file after finishing 
+        # One repaint for the whole result update instead of one per widget change
+        with self._batched_updates():
+            self._set_processing(False)
+
+            # Show result image: the worker's in-memory overlay when there is
+            # one, so the preview skips re-reading and decoding the PNG
+            overlay = results.get("overlay_array")
+            show_path = None
+            if overlay is not None:
+                self._pending_previews.pop(self.result_label, None)
+                target = QSize(_QT_MAX_SIZE, self.result_label.height())
+                self._set_preview(self.result_label, _array_to_qimage(overlay, target))
+            else:
+                show_path = results.get("overlay_path") or results.get("mask_path")
+            # No existence pre-check: a missing file simply fails to decode and
+            # _on_preview_decoded shows "No result image found." instead.
+            if show_path:
+                # The worker rewrites the same output path on every run,
+                # so drop any preview cached from a previous analysis.
+                self._preview_cache.pop(self._preview_key(show_path, self.result_label), None)
+                self._show_preview(show_path, self.result_label)
+            if overlay is not None or show_path:
+                self.result_label.setStyleSheet("")
+                self.result_label.setText("")
+            else:
+                self.result_label.setText("No result image found.")
+                self.result_label.setStyleSheet(_ERROR_STYLE)
+
+            self.result_info.setText(text)
+
+        # Auto-delete mask file after finishing (unless it is the preview
+        # being decoded, i.e. the worker produced no overlay)
         mask_path = results.get("mask_path")
-        if mask_path and os.path.exists(mask_path):
-            try:
-                os.remove(mask_path)
-            except Exception as e:
-                print(f"Warn: could not delete mask file: {e}")
+        if mask_path != show_path:
+            self._remove_mask_file(mask_path)
+
+    def _remove_mask_file(self, mask_path):
+        if not mask_path:
+            return
+        try:
+            os.remove(mask_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Warn: could not delete mask file: {e}")
 
     def on_processing_error(self, message):
-        self.is_processing = False
-        self.start_button.setEnabled(True)
-        self.cancel_button.setEnabled(False)
+        if self._cancelling:
+            self._on_cancelled()
+            return
+        self._set_processing(False)
         QMessageBox.critical(self, "Error", f"Processing failed: {message}")
 
     def cancel_analysis(self):
         if self.processing_thread and self.processing_thread.isRunning():
+            # Don't wait() on the GUI thread: the worker stops at its next
+            # checkpoint and the cancelled signal lands in _on_cancelled.
+            self._cancelling = True
             self.processing_thread.stop()
-            self.processing_thread.wait(1000)
-        self.is_processing = False
-        self.result_label.setText("Segmentation Result will appear here")
-        self.result_info.setText("Cells: —    Mean area: —")
-        self.start_button.setEnabled(True)
-        self.cancel_button.setEnabled(False)
+            self.cancel_button.setEnabled(False)
+            self.result_label.setText("Cancelling...")
+            return
+        self._on_cancelled()
+
+    def _on_cancelled(self):
+        self._cancelling = False
+        with self._batched_updates():
+            self._set_processing(False)
+            self.reset_result_preview()
+            self.result_info.setText(_EMPTY_RESULT_TEXT)
@@ -0,0 +1,37 @@
+
+import numpy as np
+from numba import njit, prange
+
+
+# Numba kernels for the worker's per-pixel image passes. worker.py imports
+# this module lazily (numba compiles on first use); cache=True keeps the
+# compiled code on disk so later app launches skip the JIT step.
+
+@njit(parallel=True, cache=True)
+def minmax(flat):
+    """Min and max of a 1-D array in one pass."""
+    lo = flat[0]
+    hi = flat[0]
+    for i in prange(flat.size):
+        v = flat[i]
+        lo = min(lo, v)
+        hi = max(hi, v)
+    return lo, hi
+
+
+@njit(parallel=True, cache=True)
+def scale_to_uint8(flat, amin, rng, hi, out):
+    """
+    out[i] = uint8(clip((flat[i] - amin) / rng, 0, 1) * hi), in one pass.
+    Same operation order as the numpy expression (no fastmath, which could
+    turn the divide into a reciprocal multiply), so pass amin/rng/hi in the
+    dtype numpy would compute in to get identical levels.
+    """
+    for i in prange(flat.size):
+        v = (flat[i] - amin) / rng
+        if v <= 0.0:
+            out[i] = 0
+        elif v >= 1.0:
+            out[i] = 255
+        else:
+            out[i] = np.uint8(v * hi)
@@ -1,11 +1,17 @@
 import sys
+import threading
 from PyQt5.QtWidgets import QApplication
 from UI import CellposeApp
+from worker import warm_up
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = CellposeApp()
     window.show()
+
+    # Load and warm up the Cellpose model while the user picks an image
+    threading.Thread(target=warm_up, args=("cyto",), daemon=True).start()
+
     sys.exit(app.exec_())
 
 
@@ -1,127 +1,530 @@
 
+import importlib.util
 import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from PyQt5.QtCore import QThread, pyqtSignal
-from cellpose import models, io, utils
+
+# Optional TensorRT engines, one per model type, built once with e.g.
+#   python cellpose/contrib/cellposetrt/trt_build.py cyto -o builds/cyto_bf16.plan
+TRT_ENGINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "builds")
+
+# Cellpose models already loaded in this process, keyed by (model_type, use_gpu).
+# A new ProcessingThread is started per analysis, but the model is only
+# constructed once and each weight file only read once (see _cache_weights).
+_MODEL_CACHE = {}
+_MODEL_LOCK = threading.Lock()
+_EVAL_LOCK = threading.Lock()
+
+# Background threads for writing result images
+_IO_POOL = ThreadPoolExecutor(max_workers=2)
+
+
+_USE_GPU = None
+
+
+def _use_gpu():
+    """Probe CUDA and apply the GPU torch settings once per process."""
+    global _USE_GPU
+    if _USE_GPU is None:
+        import torch
+        use_gpu = bool(torch.cuda.is_available())
+        if use_gpu:
+            # Let FP32 matmuls use TF32 tensor cores (Ampere+; torch >= 1.12)
+            if hasattr(torch, "set_float32_matmul_precision"):
+                torch.set_float32_matmul_precision("high")
+            # Cap the caching allocator below the full card so fragmentation
+            # over a long session hits a torch OOM, not a driver one
+            if hasattr(torch.cuda, "set_per_process_memory_fraction"):
+                torch.cuda.set_per_process_memory_fraction(0.9)
+            print(f"[Worker] Using GPU: {torch.cuda.get_device_name(0)}")
+        else:
+            print(f"[Worker] Using GPU: {use_gpu}")
+        _USE_GPU = use_gpu
+    return _USE_GPU
+
+
+def _release_gpu_memory():
+    """Return cached CUDA blocks to the driver; cached model weights stay loaded."""
+    if not _USE_GPU:
+        return
+    import gc
+    import torch
+    gc.collect()
+    torch.cuda.empty_cache()
+
+
+def _get_model(model_type, use_gpu):
+    """Return the cached Cellpose model for (model_type, use_gpu), loading it on first use."""
+    key = (model_type, use_gpu)
+    cp_model = _MODEL_CACHE.get(key)
+    if cp_model is None:
+        # Held while loading so concurrent callers wait for one load
+        # instead of each building the model
+        with _MODEL_LOCK:
+            cp_model = _MODEL_CACHE.get(key)
+            if cp_model is None:
+                cp_model = _load_model(model_type, use_gpu)
+                _MODEL_CACHE[key] = cp_model
+    return cp_model
+
+
+def _load_model(model_type, use_gpu):
+    from cellpose import models
+
+    # Prefer a prebuilt TensorRT engine on GPU when the cellpose install
+    # ships CellposeModelTRT (see TRT_ENGINE_DIR); else stock PyTorch.
+    if use_gpu:
+        try:
+            from cellpose.contrib.cellposetrt import CellposeModelTRT
+        except ImportError:
+            CellposeModelTRT = None
+        engine_path = os.path.join(TRT_ENGINE_DIR, f"{model_type}_bf16.plan")
+        if CellposeModelTRT is not None and os.path.isfile(engine_path):
+            print(f"[Worker] Using TensorRT engine: {engine_path}")
+            return CellposeModelTRT(gpu=True, pretrained_model=engine_path)
+
+    ModelClass = models.CellposeModel if hasattr(models, "CellposeModel") else models.Cellpose
+    cp_model = ModelClass(gpu=use_gpu, model_type=model_type)
+    if hasattr(cp_model, "net"):
+        _cache_weights(cp_model.net)
+
+    if use_gpu and hasattr(cp_model, "net"):
+        import torch
+        if _can_compile(torch):
+            cp_model.net = _CompiledNet(cp_model.net)
+        elif hasattr(torch.cuda, "CUDAGraph"):
+            cp_model.net = _CudaGraphNet(cp_model.net)
+    return cp_model
+
+
+def _cache_weights(net):
+    """
+    Make net.load_model() read each weights file from disk only once.
+    With net_avg (the default) Cellpose swaps its four pretrained networks
+    into the one net on every eval, each via load_model -> torch.load;
+    after the first read of a file its state dict comes from memory instead.
+    Everything else the stock CPnet.load_model does is kept.
+    """
+    import torch
+    device = next(net.parameters()).device
+    state_dicts = {}
+
+    def load_model(filename, cpu=False):
+        state_dict = state_dicts.get(filename)
+        if state_dict is None:
+            state_dict = state_dicts[filename] = torch.load(filename, map_location=device)
+        if cpu:
+            # On CPU Cellpose converts the net's layers to MKL-DNN in place
+            # on every forward; like the stock loader, rebuild dense modules
+            # first, since a dense state dict can't be copied into them
+            net.__init__(net.nbase, net.nout, net.sz, net.residual_on,
+                         net.style_on, net.concatenation, net.mkldnn)
+        # On GPU this copies into the existing parameters in place, so
+        # captured CUDA graphs / compiled code keep pointing at them
+        net.load_state_dict(state_dict)
+
+    net.load_model = load_model
+
+
+def _eval_mask(cp_model, img, use_gpu, diameter):
+    """Label mask of one image"""
+    import torch
+
+    # One eval at a time per process: a startup warm-up may overlap the
+    # first analysis, and graph-replayed nets share static buffers.
+    # inference_mode: no autograd bookkeeping, and torch drops the GIL
+    # inside its kernels so the GUI thread keeps pumping events.
+    # On GPU, autocast runs convs/matmuls in fp16 on the tensor cores.
+    with _EVAL_LOCK, torch.inference_mode(), \
+            torch.autocast(device_type="cuda", dtype=torch.float16, enabled=use_gpu):
+        masks, flows, styles = cp_model.eval(
+            [img],
+            diameter=diameter,
+            channels=[0, 0]  # default: grayscale. Adjust here if you need color channels.
+        )
+    return masks[0]
+
+
+def warm_up(model_type="cyto"):
+    """
+    Load `model_type` into the model cache and run one tiny eval, so
+    weights, CUDA context and any kernel autotuning/compilation are ready
+    before the first real analysis. Meant for a background thread.
+    """
+    try:
+        use_gpu = _use_gpu()
+        cp_model = _get_model(model_type, use_gpu)
+        _eval_mask(cp_model, np.zeros((256, 256), np.uint8), use_gpu, 30)
+        print(f"[Worker] Model '{model_type}' warmed up.")
+    except Exception as e:
+        print(f"[Worker] Warm-up failed (will load on first analysis): {e}")
+
+
+def _torch_version(torch):
+    """(major, minor) of the installed torch, e.g. (1, 10)"""
+    major, minor = torch.__version__.split(".")[:2]
+    return int(major), int("".join(c for c in minor if c.isdigit()) or 0)
+
+
+def _can_compile(torch):
+    """Whether torch.compile's default (Inductor/Triton) backend can run here."""
+    # torch 2.1 refuses to compile on Windows, and without Triton Inductor
+    # only fails at the first forward pass
+    return (_torch_version(torch) >= (2, 1) and sys.platform != "win32"
+            and importlib.util.find_spec("triton") is not None)
+
+
+class _CompiledNet:
+    """
+    Wraps a Cellpose network in torch.compile: Inductor fuses the elementwise
+    ops between convs, and reduce-overhead also replays the result through
+    CUDA graphs. If compiling fails (at wrap time or on a forward pass, where
+    torch.compile actually builds the kernels) it falls back to the eager net
+    for good. Anything other than calling the net is passed through to it.
+    """
+    def __init__(self, net):
+        import torch
+        self._net = net
+        self._compiled_ok = False   # True once a compiled forward has succeeded
+        try:
+            self._compiled = torch.compile(net, mode="reduce-overhead", fullgraph=False)
+        except Exception as e:
+            self._disable(e)
+
+    def __getattr__(self, name):
+        return getattr(self._net, name)
+
+    def __call__(self, x):
+        if self._compiled is not None:
+            try:
+                y = self._compiled(x)
+                self._compiled_ok = True
+                return y
+            except Exception as e:
+                # After a first success only compiler errors (e.g. on a
+                # recompile for a new shape) fall back; others are real
+                if self._compiled_ok and not self._is_compile_error(e):
+                    raise
+                self._disable(e)
+        return self._net(x)
+
+    def _disable(self, e):
+        print(f"[Worker] torch.compile unavailable, using the eager network: {e}")
+        self._compiled = None
+
+    @staticmethod
+    def _is_compile_error(e):
+        import torch
+        exc = getattr(getattr(torch, "_dynamo", None), "exc", None)
+        base = getattr(exc, "TorchDynamoException", None)
+        return base is not None and isinstance(e, base)
+
+
+class _CudaGraphNet:
+    """
+    Wraps a Cellpose network so that the forward pass for each input
+    shape is captured once as a CUDA graph and replayed afterwards.
+    Cellpose feeds the net fixed-size tiles, so after the first batch
+    every call is a single graph launch instead of one launch per kernel.
+    Anything other than calling the net is passed through to it.
+    """
+    def __init__(self, net):
+        self._net = net
+        self._graphs = {}   # (shape, dtype, autocast) -> (graph, static_in, static_out)
+
+    def __getattr__(self, name):
+        return getattr(self._net, name)
+
+    def __call__(self, x):
+        import torch
+        if not x.is_cuda:
+            return self._net(x)
+
+        key = (tuple(x.shape), x.dtype, torch.is_autocast_enabled())
+        entry = self._graphs.get(key)
+        if entry is None:
+            entry = self._graphs[key] = self._capture(x)
+        graph, static_in, static_out = entry
+
+        static_in.copy_(x)
+        graph.replay()
+        # Clone: the static outputs are overwritten by the next replay
+        if isinstance(static_out, torch.Tensor):
+            return static_out.clone()
+        return tuple(t.clone() for t in static_out)
+
+    def _capture(self, x):
+        import torch
+        static_in = x.clone()
+
+        # Warm up on a side stream first (cuDNN autotuning, allocator),
+        # as required before capture
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self._net(static_in)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_out = self._net(static_in)
+        if not isinstance(static_out, torch.Tensor):
+            static_out = tuple(static_out)
+        return graph, static_in, static_out
 
 
 class ProcessingThread(QThread):
     """
-    Background processing thread that runs Cellpose segmentation on CPU.
+    Background processing thread that runs Cellpose segmentation
+    (on a CUDA GPU when torch can see one, otherwise on CPU).
 
     Emits:
         finished(dict): {
             "cell_count": int,
             "mean_area_px": float,
-            "mask_path": str,
-            "overlay_path": str
+            "mask_path": str or None,
+            "overlay_path": str or None,
+            "overlay_array": ndarray or None
         }
         error(str): error message
+        cancelled(): stop() was honoured; neither finished nor error follows
     """
     finished = pyqtSignal(object)
     error = pyqtSignal(str)
+    cancelled = pyqtSignal()
 
-    def __init__(self, image_path, diameter=None, model="cyto", output_folder="."):
+    def __init__(self, image_path, diameter=None, model="cyto", output_folder=".",
+                 need_overlay=True, save_outputs=True):
         super().__init__()
         self.image_path = image_path
         self.diameter = diameter        # currently not used (None), kept for future extension
         self.model = model              # "cyto" or "nuclei"
         self.output_folder = output_folder or "."
-        self._is_running = True
+        # False: skip building/saving the overlay (render_overlay can make one later)
+        self.need_overlay = need_overlay
+        # False: write no PNGs (headless batch runs that only need the stats/arrays)
+        self.save_outputs = save_outputs
 
     def run(self):
         try:
+            # cellpose (and torch) are imported lazily rather than at module level:
+            # they take seconds to load, and UI.py imports this module at
+            # startup. Importing in run() also keeps that cost off the GUI thread.
+            from cellpose import io
+
             if not self.image_path or not os.path.exists(self.image_path):
                 raise ValueError(f"Image file not found: {self.image_path}")
 
             os.makedirs(self.output_folder, exist_ok=True)
 
-            img = io.imread(self.image_path)
+            img = self._read_image(io, self.image_path)
             if img is None:
                 raise ValueError("Failed to read image (io.imread returned None)")
 
-            # --- Force CPU (no GPU for now) ---
-            use_gpu = False
-            print(f"[Worker] Using GPU: {use_gpu}")
+            use_gpu = _use_gpu()
+            cp_model = _get_model(self.model, use_gpu)
 
-            ModelClass = models.CellposeModel if hasattr(models, "CellposeModel") else models.Cellpose
-            cp_model = ModelClass(gpu=use_gpu, model_type=self.model)
+            if self._check_cancelled():
+                return
 
-            # --- Segmentation ---
-            masks, flows, styles = cp_model.eval(
-                [img],
-                diameter=self.diameter,
-                channels=[0, 0]  # default: grayscale. Adjust here if you need color channels.
-            )
+            mask = _eval_mask(cp_model, img, use_gpu, self.diameter)
 
-            if not self._is_running:
-                print("[Worker] Processing cancelled.")
+            if self._check_cancelled():
                 return
 
-            mask = masks[0]
+            self.finished.emit(self._finish_image(io, img, mask))
 
-            # ---- Compute cell_count and mean area in pixels ----
-            # labels: unique values in mask, counts: number of pixels for each label
-            labels, counts = np.unique(mask, return_counts=True)
-            if labels.size > 0 and labels[0] == 0:
-                labels = labels[1:]
-                counts = counts[1:]
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            self.error.emit(str(e))
+
+        finally:
+            # Drop this run's arrays before freeing, so a long session of
+            # analyses doesn't build up fragmented GPU allocations
+            img = mask = None
+            _release_gpu_memory()
 
-            cell_count = int(len(labels))
-            if cell_count > 0 and counts.size > 0:
-                mean_area_px = float(counts.mean())  # average number of pixels per cell
-            else:
-                mean_area_px = 0.0
+    def _read_image(self, io, path):
+        # Uncompressed TIFFs are memory-mapped instead of decoded into a heap
+        # array: the source pixels are file-backed pages the OS can drop and
+        # re-read, rather than one more anonymous copy of the image. Cellpose
+        # still reads the whole image at once (eval makes its own float32
+        # copy before tiling), so this saves that one copy, not per-tile paging.
+        # Copy-on-write ("c") keeps the file untouched if anything writes to it.
+        if path.lower().endswith((".tif", ".tiff")):
+            import tifffile
+            try:
+                m = tifffile.memmap(path, mode="c")
+            except ValueError:
+                m = None  # compressed or tiled data can't be mapped; decode normally
+            # Big-endian files (ImageJ's default) map as e.g. >u2; imread
+            # returns native order, which numpy/numba consumers expect
+            if m is not None and m.dtype.isnative:
+                return m
+        return io.imread(path)
 
-            # --- Save results ---
-            base = os.path.splitext(os.path.basename(self.image_path))[0]
+    @staticmethod
+    def _cell_stats(mask):
+        """(cell_count, mean_area_px, max_label) of a label mask"""
+        # ---- Compute cell_count and mean area in pixels ----
+        # counts[k]: number of pixels with label k. Labels are small non-negative
+        # ints, so one O(N) bincount pass replaces sorting the mask (np.unique).
+        counts = np.bincount(mask.ravel())
+        max_label = counts.size - 1
+        counts = counts[1:]                # drop background label 0
+        counts = counts[counts > 0]        # drop label ids not present
+
+        cell_count = int(counts.size)
+        if cell_count > 0:
+            mean_area_px = float(counts.mean())  # average number of pixels per cell
+        else:
+            mean_area_px = 0.0
+        return cell_count, mean_area_px, max_label
+
+    def _finish_image(self, io, img, mask):
+        """Compute stats for the segmented image, save its outputs and build the result dict"""
+        cell_count, mean_area_px, max_label = self._cell_stats(mask)
+
+        # --- Save results ---
+        base = os.path.splitext(os.path.basename(self.image_path))[0]
+        mask_path = None
+        writes = []
+        if self.save_outputs:
             mask_path = os.path.join(self.output_folder, f"{base}_masks.png")
-            io.imsave(mask_path, mask.astype(np.uint16))
+            # Narrowest PNG depth that holds every label: 8-bit halves the bytes to
+            # deflate and write for masks with < 256 cells (PNG tops out at 16-bit)
+            mask_dtype = np.uint8 if max_label < 256 else np.uint16
+            # PNG encoding runs on _IO_POOL (cv2/tifffile release the GIL), so the
+            # mask write overlaps building the overlay and the overlay write
+            writes.append(_IO_POOL.submit(io.imsave, mask_path, mask.astype(mask_dtype, copy=False)))
 
-            # --- Build overlay preview ---
-            outlines = utils.masks_to_outlines(mask)  # boolean boundary map
-            overlay = self._make_overlay(img, outlines)
-            overlay_path = os.path.join(self.output_folder, f"{base}_overlay.png")
-            io.imsave(overlay_path, overlay)
+        # --- Build overlay preview (skipped when nobody will look at it) ---
+        overlay = None
+        overlay_path = None
+        if self.need_overlay:
+            overlay = np.ascontiguousarray(self.render_overlay(img, mask))
+            if self.save_outputs:
+                overlay_path = os.path.join(self.output_folder, f"{base}_overlay.png")
+                writes.append(_IO_POOL.submit(io.imsave, overlay_path, overlay))
 
-            result = {
-                "cell_count": cell_count,
-                "mean_area_px": mean_area_px,
-                "mask_path": mask_path,        # UI may delete this after showing overlay
-                "overlay_path": overlay_path
-            }
+        # The UI deletes the mask as soon as it gets the result, so the
+        # files must be complete before it is emitted.
+        # result() re-raises any write error into run()'s handler.
+        for f in writes:
+            f.result()
 
-            print(f"[Worker] Done. Cells: {cell_count}, Mean area: {mean_area_px:.2f} px^2")
-            self.finished.emit(result)
+        result = {
+            "cell_count": cell_count,
+            "mean_area_px": mean_area_px,
+            "mask_path": mask_path,        # UI may delete this after showing overlay
+            "overlay_path": overlay_path,  # None when need_overlay or save_outputs is False
+            "overlay_array": overlay       # contiguous HxWx3 uint8 RGB, None without need_overlay
+        }
 
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            self.error.emit(str(e))
+        print(f"[Worker] Done. Cells: {cell_count}, Mean area: {mean_area_px:.2f} px^2")
+        return result
 
     def stop(self):
-        self._is_running = False
+        """Ask the thread to stop at its next checkpoint; does not block."""
+        self.requestInterruption()
+
+    def _check_cancelled(self):
+        if not self.isInterruptionRequested():
+            return False
+        print("[Worker] Processing cancelled.")
+        self.cancelled.emit()
+        return True
 
-    def _make_overlay(self, img, outlines_bool):
+    @classmethod
+    def render_overlay(cls, img, mask):
+        """RGB uint8 copy of `img` with the outlines of the cells in `mask` drawn in red"""
+        return cls._make_overlay(img, cls._masks_to_outlines(mask))
+
+    @staticmethod
+    def _masks_to_outlines(mask):
+        """
+        Boolean map of labelled pixels with a 4-neighbour of a different
+        label (or on the image edge), i.e. each cell's one-pixel inner
+        boundary like cellpose's utils.masks_to_outlines, but from four
+        whole-array comparisons instead of a Python loop over every cell.
+        """
+        edge = np.zeros(mask.shape, dtype=bool)
+        # Shifted slice comparisons: no np.roll copies and no wrap-around
+        diff = mask[1:, :] != mask[:-1, :]
+        edge[1:, :] |= diff
+        edge[:-1, :] |= diff
+        diff = mask[:, 1:] != mask[:, :-1]
+        edge[:, 1:] |= diff
+        edge[:, :-1] |= diff
+        edge[0, :] = edge[-1, :] = True
+        edge[:, 0] = edge[:, -1] = True
+        edge &= mask != 0
+        return edge
+
+    @classmethod
+    def _make_overlay(cls, img, outlines_bool):
+        # Single output allocation: gray is broadcast straight into the three
+        # channels (no np.stack temporary), RGB is copied at most once.
         if img.ndim == 2:
-            arr = self._to_uint8(img)
-            rgb = np.stack([arr, arr, arr], axis=-1)
+            arr = cls._to_uint8(img)
+            overlay = np.empty(arr.shape + (3,), dtype=np.uint8)
+            overlay[...] = arr[..., None]
         else:
-            rgb = self._to_uint8(img)
-            if rgb.shape[-1] == 4:
-                rgb = rgb[..., :3]
+            # Drop alpha with a view *before* converting, so the alpha plane is
+            # never rescaled/copied and doesn't skew the min/max normalisation
+            if img.shape[-1] == 4:
+                img = img[..., :3]
+            overlay = cls._to_uint8(img)
+            # Non-uint8 input comes back as a fresh buffer we can draw on;
+            # uint8 comes back as (a view of) img itself, so copy that once
+            if np.may_share_memory(overlay, img):
+                overlay = overlay.copy()
 
-        overlay = rgb.copy()
         overlay[outlines_bool] = np.array([255, 0, 0], dtype=np.uint8)
         return overlay
 
-    def _to_uint8(self, a):
+    @staticmethod
+    def _to_uint8(a):
         a = np.asarray(a)
         if a.dtype == np.uint8:
             return a
-        amin, amax = float(np.min(a)), float(np.max(a))
+        if not a.dtype.isnative:
+            a = a.astype(a.dtype.newbyteorder("="))
+        if not (a.dtype.kind in "iu" or a.dtype in (np.float32, np.float64)):
+            # float16, bool, ...: dtypes the kernels can't type
+            amin, amax = float(np.min(a)), float(np.max(a))
+            if amax <= amin:
+                return np.zeros_like(a, dtype=np.uint8)
+            scaled = (a - amin) / (amax - amin)
+            scaled = np.clip(scaled, 0, 1)
+            return (scaled * 255.0).astype(np.uint8)
+
+        from kernels import minmax, scale_to_uint8
+
+        # Fused kernels: one read pass for min/max, one read+write pass
+        # for the rescale, instead of separate min/max/sub/div/clip/cast passes
+        flat = np.ascontiguousarray(a).reshape(-1)
+        amin, amax = minmax(flat)
+        amin, amax = float(amin), float(amax)
         if amax <= amin:
             return np.zeros_like(a, dtype=np.uint8)
-        scaled = (a - amin) / (amax - amin)
-        scaled = np.clip(scaled, 0, 1)
-        return (scaled * 255.0).astype(np.uint8)
+        # numpy's (a - amin) / (amax - amin) * 255.0 stays float32 for
+        # float32 input and is float64 otherwise; match it exactly
+        ftype = np.float32 if a.dtype == np.float32 else np.float64
+        args = ftype(amin), ftype(amax - amin), ftype(255.0)
+        if a.dtype in (np.uint16, np.int16):
+            # 16-bit input: rescale all 65536 possible values once and
+            # gather, rather than running the float rescale per pixel.
+            # Indexing by the uint16 view keeps int16 in range too.
+            values = np.arange(65536, dtype=np.uint16).view(a.dtype).astype(np.float64)
+            lut = np.empty(values.size, dtype=np.uint8)
+            scale_to_uint8(values, *args, lut)
+            return lut[a.view(np.uint16)]
+        out = np.empty(flat.size, dtype=np.uint8)
+        scale_to_uint8(flat, *args, out)
+        return out.reshape(a.shape)